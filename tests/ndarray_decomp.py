@@ -4,8 +4,149 @@ results gotten by doing similar decompositions of various instances of
 TensorCommon.
 """
 import numpy as np
+import scipy.linalg as spla
+import scipy.sparse.linalg as spsla
+import functools as fct
+import operator as opr
 from collections.abc import Iterable
 
+# The smallest min(dim_a, dim_b) for which svd considers using a sparse SVD.
+_SPARSE_SVD_MIN_DIM = 128
+
+
+def _format_indices(T, a, b):
+    """Return the index groups a and b as tuples, followed by the output of
+    _matrix_layout for them.
+    """
+    # We want to deal with tuples, not lists or bare integers
+    a = tuple(a) if isinstance(a, Iterable) else (a,)
+    b = tuple(b) if isinstance(b, Iterable) else (b,)
+    return (a, b) + _matrix_layout(T.shape, a, b)
+
+
+def _matrix_layout(shape, a, b):
+    """Return the dimensions shp_a and shp_b of the indices a and b of a
+    tensor of the given shape, and the dimensions dim_a and dim_b of the
+    matrix that is formed when the indices in a and b are joined together.
+    """
+    assert len(a) + len(b) == len(shape)
+    shp_a = tuple(shape[i] for i in a)
+    shp_b = tuple(shape[i] for i in b)
+    dim_a = fct.reduce(opr.mul, shp_a, 1)
+    dim_b = fct.reduce(opr.mul, shp_b, 1)
+    return shp_a, shp_b, dim_a, dim_b
+
+
+def _format_chis(chis, eps, min_dim):
+    """Format the truncation parameters to canonical form.
+
+    The return value is a sorted list of the possible chis, with only the
+    largest one if eps <= 0. If chis is None and eps > 0 all chis up to
+    min_dim are possible, and None is returned instead of listing them.
+    """
+    if chis is None:
+        if eps <= 0:
+            chis = [min_dim]
+    else:
+        try:
+            chis = list(chis)
+        except TypeError:
+            chis = [chis]
+        if eps <= 0:
+            chis = [max(chis)]
+        else:
+            chis = sorted(chis)
+    return chis
+
+
+def _fortran_matrix(T, rows, cols, dim_rows, dim_cols):
+    """Return T reshaped into a dim_rows x dim_cols matrix, with the indices
+    rows joined to form the first index of the matrix and the indices cols the
+    second.
+
+    The matrix is formed by copying the permuted elements of T exactly once,
+    into a new Fortran ordered array. LAPACK works with Fortran ordered
+    arrays, so it can then use and overwrite the matrix without further
+    copies.
+    """
+    T_matrix = np.transpose(T, cols + rows).copy(order="C")
+    return T_matrix.reshape((dim_cols, dim_rows)).T
+
+
+def _degeneracy_safe_chis(s_sq, degeneracy_eps):
+    """Return, in increasing order, all the chis such that truncating a
+    spectrum to chi doesn't keep some but not all of a set of degenerate
+    values. s_sq should be the squares of the absolute values of the
+    spectrum, in descending order.
+
+    Two values a >= b >= 0 are degenerate if abs(a - b) / ((a + b) / 2) <
+    degeneracy_eps. This is equivalent to b > thr * a, with thr = (2 -
+    degeneracy_eps) / (2 + degeneracy_eps), or a == 0, which can be checked
+    using the squares of a and b, without taking square roots.
+    """
+    last_in = s_sq[:-1]
+    last_out = s_sq[1:]
+    thr = (2 - degeneracy_eps) / (2 + degeneracy_eps)
+    is_degenerate = last_out > thr * abs(thr) * last_in
+    if degeneracy_eps > 0:
+        is_degenerate |= last_in == 0
+    # Truncating to 0 or len(s_sq) is always safe.
+    is_safe = np.ones(len(s_sq) + 1, dtype=np.bool_)
+    is_safe[1:-1] = ~is_degenerate
+    return np.flatnonzero(is_safe)
+
+
+def _select_chi(
+    s_sq, chis, eps, break_degenerate, degeneracy_eps, norm_sq=None
+):
+    """Return the dimension chi to truncate a spectrum to, and the relative
+    truncation error made in doing so.
+
+    s_sq should be the squares of the absolute values of the spectrum, in
+    descending order, and chis should be as returned by _format_chis. If s_sq
+    is only the beginning of the spectrum, norm_sq should be the sum of s_sq
+    over the whole spectrum.
+    """
+    if norm_sq is None and chis is not None and chis[0] >= len(s_sq):
+        # Even the smallest chi keeps the whole spectrum, so nothing is
+        # truncated. This is the case for instance if eps <= 0 and chis
+        # wasn't given.
+        return chis[0], 0.0
+    sum_all_sq = float(s_sq.sum())
+    # disc_sq[chi] is the sum of the squares of the values that are discarded
+    # when truncating to chi, for chi = 0, ..., len(s_sq).
+    disc_sq = np.append(np.cumsum(s_sq[::-1])[::-1], 0.0)
+    if norm_sq is not None:
+        # s is only part of the spectrum, so add the weight of the rest.
+        disc_sq += max(norm_sq - sum_all_sq, 0.0)
+        sum_all_sq = norm_sq
+    if sum_all_sq == 0:
+        chi = 0 if chis is None else min(chis)
+        return chi, 0
+    if chis is None:
+        # Find the smallest chi with a small enough error, and raise it, if
+        # necessary, to the closest one that doesn't break degeneracies.
+        errs = np.sqrt(disc_sq / sum_all_sq)
+        chi = np.searchsorted(-errs, -eps, side="right")
+        if not break_degenerate:
+            safe_chis = _degeneracy_safe_chis(s_sq, degeneracy_eps)
+            chi = safe_chis[np.searchsorted(safe_chis, chi)]
+        return int(chi), errs[chi]
+    chis = np.minimum(chis, len(s_sq))
+    if not break_degenerate:
+        # Make sure that we don't break degenerate singular values by
+        # including one but not the other, by lowering each chi to the closest
+        # one that is safe.
+        safe_chis = _degeneracy_safe_chis(s_sq, degeneracy_eps)
+        i = np.searchsorted(safe_chis, chis, side="right") - 1
+        chis = safe_chis[i]
+    errs = np.sqrt(disc_sq[chis] / sum_all_sq)
+    # Find the smallest chi for which the error is small enough. If none is
+    # found, use the largest chi. chis is sorted, so errs is non-increasing,
+    # and this can be done by bisection.
+    i = min(np.searchsorted(-errs, -eps, side="right"), len(chis) - 1)
+    return int(chis[i]), errs[i]
+
 
 def svd(
     T,
@@ -16,6 +157,7 @@ def svd(
     return_rel_err=False,
     break_degenerate=False,
     degeneracy_eps=1e-6,
+    compute_uv=True,
 ):
     """Reshapes the tensor T have indices a on one side and indices b on the
     other, SVDs it as a matrix and reshapes the parts back to the original
@@ -42,94 +184,97 @@ def svd(
     U.diag(s).V = T, where the equality is appromixate if there is truncation.
     If return_rel_err = True a fourth value is returned, which is the ratio
     sum_of_discarded_singular_values / sum_of_all_singular_values.
+
+    If compute_uv = False only the singular values are computed, which is
+    considerably cheaper, and the function returns s, or (s, rel_err) if
+    return_rel_err = True.
     """
+    a, b, shp_a, shp_b, dim_a, dim_b = _format_indices(T, a, b)
+    min_dim = min(dim_a, dim_b)
+    chis = _format_chis(chis, eps, min_dim)
 
-    # We want to deal with lists, not tuples or bare integers
-    if isinstance(a, Iterable):
-        a = list(a)
-    else:
-        a = [a]
-    if isinstance(b, Iterable):
-        b = list(b)
-    else:
-        b = [b]
-    assert len(a) + len(b) == len(T.shape)
-
-    # Permute the indices of T to the right order
-    perm = tuple(a + b)
-    T_matrix = np.transpose(T, perm)
-    # The lists shp_a and shp_b list the dimensions of the bonds in a and b
-    shp = T_matrix.shape
-    shp_a = shp[: len(a)]
-    shp_b = shp[-len(b) :]
-
-    # Compute the dimensions of the the matrix that will be formed when indices
-    # of a and b are joined together.
-    dim_a = 1
-    for s in shp_a:
-        dim_a = dim_a * s
-    dim_b = 1
-    for s in shp_b:
-        dim_b = dim_b * s
-    # Create the matrix and SVD it.
-    T_matrix = np.reshape(T_matrix, (dim_a, dim_b))
-    U, s, V = np.linalg.svd(T_matrix, full_matrices=False)
-
-    # Format the truncation parameters to canonical form.
-    if chis is None:
-        min_dim = min(dim_a, dim_b)
-        if eps > 0:
-            # Try all possible chis.
-            chis = list(range(min_dim + 1))
-        else:
-            chis = [min_dim]
-    else:
+    # If only a small fraction of a large spectrum can be kept, find just that
+    # part of it with a sparse SVD, plus one more singular value for checking
+    # for degeneracies. The Frobenius norm of T then accounts for the rest of
+    # the spectrum when computing the truncation error. For small matrices
+    # ARPACK is slower than a full SVD, and it only accepts single and double
+    # precision real and complex matrices.
+    res = None
+    norm_sq = None
+    if (
+        eps <= 0
+        and T.dtype.char in "fdFD"
+        and min_dim >= _SPARSE_SVD_MIN_DIM
+        and max(chis) + 1 < 0.1 * min_dim
+    ):
+        k = max(chis) + 1
+        T_matrix = _fortran_matrix(T, a, b, dim_a, dim_b)
+        # Use a fixed starting vector, so that the result is reproducible and
+        # ARPACK doesn't draw from, and advance, the global random state.
+        v0 = np.random.RandomState(0).uniform(-1, 1, size=min_dim)
         try:
-            chis = list(chis)
-        except TypeError:
-            chis = [chis]
-        if eps <= 0:
-            chis = [max(chis)]
+            res = spsla.svds(
+                T_matrix,
+                k=k,
+                v0=v0.astype(T_matrix.dtype),
+                return_singular_vectors=compute_uv,
+            )
+        except spsla.ArpackNoConvergence:
+            pass
         else:
-            chis = sorted(chis)
-
-    sum_all_sq = sum(s ** 2)
-    # Find the smallest chi for which the error is small enough.
-    # If none is found, use the largest chi.
-    if sum(s) != 0:
-        last_out = s[0]
-        for chi in chis:
-            if not break_degenerate:
-                # Make sure that we don't break degenerate singular values
-                # by including one but not the other.
-                while 0 < chi < len(s):
-                    last_in = s[chi - 1]
-                    last_out = s[chi]
-                    rel_diff = np.abs(last_in - last_out)
-                    avg = (last_in + last_out) / 2
-                    if avg != 0:
-                        rel_diff /= avg
-                    if rel_diff < degeneracy_eps:
-                        chi -= 1
-                    else:
-                        break
-            sum_disc_sq = sum((s ** 2)[chi:])
-            if sum_all_sq != 0:
-                err = np.sqrt(sum_disc_sq / sum_all_sq)
+            norm_sq = np.vdot(T, T).real
+            # svds doesn't return the singular values in descending order.
+            if compute_uv:
+                U, s, V = res
+                order = np.argsort(-s)
+                res = U[:, order], s[order], V[order, :]
             else:
-                err = 0
-            if err < eps:
-                break
+                res = np.sort(res)[::-1]
+    if res is None:
+        # Create the matrix and SVD it.
+        T_matrix = _fortran_matrix(T, a, b, dim_a, dim_b)
+        try:
+            res = spla.svd(
+                T_matrix,
+                full_matrices=False,
+                compute_uv=compute_uv,
+                overwrite_a=True,
+                check_finite=False,
+                lapack_driver="gesdd",
+            )
+        except spla.LinAlgError:
+            # gesdd occasionally fails to converge when the slower gesvd
+            # doesn't. The failed attempt may have overwritten T_matrix, so
+            # recreate it.
+            T_matrix = _fortran_matrix(T, a, b, dim_a, dim_b)
+            res = spla.svd(
+                T_matrix,
+                full_matrices=False,
+                compute_uv=compute_uv,
+                check_finite=False,
+                lapack_driver="gesvd",
+            )
+    if compute_uv:
+        U, s, V = res
     else:
-        err = 0
-        chi = min(chis)
+        s = res
+
+    chi, err = _select_chi(
+        s * s, chis, eps, break_degenerate, degeneracy_eps, norm_sq=norm_sq
+    )
     # Truncate
     s = s[:chi]
+    if not compute_uv:
+        if return_rel_err:
+            return s, err
+        return s
     U = U[:, :chi]
     V = V[:chi, :]
 
     # Reshape U and V to tensors with shapes matching the shape of T and
-    # return.
+    # return. The reshapes only split the first index of U and the second
+    # index of V, so they return views and nothing is copied, whether or not
+    # U and V were truncated.
     U_tens = np.reshape(U, shp_a + (-1,))
     V_tens = np.reshape(V, (-1,) + shp_b)
     ret_val = U_tens, s, V_tens
@@ -158,99 +303,65 @@ def eig(
     U, (rel_err), where S includes the eigenvalues and U[...,i] is the left
     eigenvector corresponding to S[i]. The first legs of U are compatible with
     the legs b of T.
+
+    If hermitian = "auto", the matrix is checked for being hermitian, up to a
+    tolerance of 1e-12 times its largest element in absolute value, and if it
+    is, it is decomposed as such. Note that S is then real, even if T is
+    complex.
     """
-    # We want to deal with lists, not tuples or bare integers
-    if isinstance(a, Iterable):
-        a = list(a)
-    else:
-        a = [a]
-    if isinstance(b, Iterable):
-        b = list(b)
-    else:
-        b = [b]
-    assert len(a) + len(b) == len(T.shape)
-
-    # Permute the indices of T to the right order
-    perm = tuple(a + b)
-    T_matrix = np.transpose(T, perm)
-    # The lists shp_a and shp_b list the dimensions of the bonds in a and b.
-    shp = T_matrix.shape
-    shp_a = shp[: len(a)]
-    shp_b = shp[-len(b) :]
-
-    # Compute the dimensions of the the matrix that will be formed when indices
-    # of a and b are joined together.
-    dim_a = 1
-    for s in shp_a:
-        dim_a = dim_a * s
-    dim_b = 1
-    for s in shp_b:
-        dim_b = dim_b * s
+    a, b, shp_a, shp_b, dim_a, dim_b = _format_indices(T, a, b)
+    chis = _format_chis(chis, eps, min(dim_a, dim_b))
+
     # Create the matrix and eigenvalue decompose it.
-    T_matrix = np.reshape(T_matrix, (dim_a, dim_b))
+    T_matrix = _fortran_matrix(T, a, b, dim_a, dim_b)
+    if hermitian == "auto":
+        # The check is cheap compared to the decomposition, and eigh is
+        # considerably faster than eig. The tolerance is scaled by the whole
+        # matrix, not element by element, so that rounding noise in place of
+        # an exact zero doesn't fail the check.
+        atol = 1e-12 * np.abs(T_matrix).max(initial=0)
+        hermitian = dim_a == dim_b and np.allclose(
+            T_matrix, T_matrix.conj().T, rtol=0, atol=atol
+        )
     if hermitian:
-        S, U = np.linalg.eigh(T_matrix)
+        S, U = spla.eigh(T_matrix, overwrite_a=True, check_finite=False)
     else:
-        S, U = np.linalg.eig(T_matrix)
-
-    order = np.argsort(-np.abs(S))
-    S = S[order]
-    U = U[:, order]
+        S, U = spla.eig(T_matrix, overwrite_a=True, check_finite=False)
+        if not np.iscomplexobj(T_matrix) and not S.imag.any():
+            # Like np.linalg.eig, return real eigenpairs if T is real and has
+            # a real spectrum.
+            S, U = S.real, U.real
 
-    # Format the truncation parameters to canonical form.
-    if chis is None:
-        max_dim = min(dim_a, dim_b)
-        if eps > 0:
-            # Try all possible chis.
-            chis = list(range(max_dim + 1))
-        else:
-            chis = [max_dim]
+    # Only the max(chis) largest eigenvalues can be kept, so only they, and
+    # the next one that is needed for checking for degeneracies, need to be
+    # sorted. The rest are left after them, in arbitrary order.
+    # The squares of the absolute values are enough for ordering and
+    # truncating, and they don't require square roots.
+    if np.iscomplexobj(S):
+        S_abs_sq = S.real * S.real + S.imag * S.imag
     else:
-        if isinstance(chis, Iterable):
-            chis = list(chis)
-        else:
-            chis = [chis]
-        if eps == 0:
-            chis = [max(chis)]
-        else:
-            chis = sorted(chis)
-
-    S_abs = abs(S)
-    sum_all_sq = sum(S_abs ** 2)
-    # Find the smallest chi for which the error is small enough.
-    # If none is found, use the largest chi.
-    if sum(S_abs) != 0:
-        last_out = S_abs[0]
-        for chi in chis:
-            if not break_degenerate:
-                # Make sure that we don't break degenerate singular values
-                # by including one but not the other.
-                while 0 < chi < len(S_abs):
-                    last_in = S_abs[chi - 1]
-                    last_out = S_abs[chi]
-                    rel_diff = np.abs(last_in - last_out)
-                    avg = (last_in + last_out) / 2
-                    if avg != 0:
-                        rel_diff /= avg
-                    if rel_diff < degeneracy_eps:
-                        chi -= 1
-                    else:
-                        break
-            sum_disc_sq = sum((S_abs ** 2)[chi:])
-            if sum_all_sq != 0:
-                err = np.sqrt(sum_disc_sq / sum_all_sq)
-            else:
-                err = 0
-            if err < eps:
-                break
+        S_abs_sq = S * S
+    k = len(S) if chis is None else max(chis)
+    if k < len(S) - 1:
+        part = np.argpartition(-S_abs_sq, k)
+        top = part[: k + 1]
+        top = top[np.argsort(-S_abs_sq[top])]
+        order = np.concatenate((top, part[k + 1 :]))
     else:
-        err = 0
-        chi = min(chis)
+        order = np.argsort(-S_abs_sq)
+    S = S[order]
+    S_abs_sq = S_abs_sq[order]
+
+    chi, err = _select_chi(
+        S_abs_sq, chis, eps, break_degenerate, degeneracy_eps
+    )
     # Truncate
     S = S[:chi]
-    U = U[:, :chi]
+    # Gather only the eigenvectors that are kept.
+    U = U[:, order[:chi]]
 
     # Reshape U to a tensor with shape matching the shape of T and return.
+    # The reshape only splits the first index of U, so it returns a view.
     U_tens = np.reshape(U, shp_a + (-1,))
     ret_val = S, U_tens
     if return_rel_err:
@@ -0,0 +1,230 @@
+"""Tests for the ndarray_decomp module, that the main test suite uses as a
+reference for decompositions of TensorCommon instances.
+"""
+import numpy as np
+import scipy.linalg as spla
+import scipy.sparse.linalg as spsla
+from . import ndarray_decomp
+from .ndarray_decomp import svd, eig
+
+# # # # # # # # # # # # # # # # # # # #
+# Utilities that tests use
+
+
+def random_isometry(m, n):
+    """Return a random complex m x n matrix with orthonormal columns."""
+    X = np.random.randn(m, n) + 1j * np.random.randn(m, n)
+    return np.linalg.qr(X)[0]
+
+
+def random_spectrum(n):
+    """Return n random, non-degenerate singular values in descending order.
+
+    The values are evenly spaced between 1 and 0.1, and jittered by less than
+    half the spacing, so that neighbouring values always differ by far more
+    than the default degeneracy_eps of svd.
+    """
+    spacing = 0.9 / max(n - 1, 1)
+    jitter = np.random.uniform(-0.25, 0.25, size=n) * spacing
+    return np.linspace(1, 0.1, n) + jitter
+
+
+def random_sparse_svd_shape():
+    """Return a random shape of a three-index tensor, that svd decomposes with
+    a sparse SVD when its first index is on one side and the rest on the
+    other, and the decomposition is truncated to at most five singular values.
+    """
+    m = np.random.randint(low=130, high=170)
+    n1 = np.random.randint(low=10, high=14)
+    n2 = np.random.randint(low=13, high=17)
+    return m, n1, n2
+
+
+def count_calls(monkeypatch, module, name):
+    """Make the function module.name count how many times it's called, and
+    return a list, the length of which is the number of calls.
+    """
+    calls = []
+    orig_f = getattr(module, name)
+
+    def counting_f(*args, **kwargs):
+        calls.append(None)
+        return orig_f(*args, **kwargs)
+
+    monkeypatch.setattr(module, name, counting_f)
+    return calls
+
+
+def count_svds_calls(monkeypatch):
+    """Make scipy.sparse.linalg.svds count how many times it's called, and
+    return a list, the length of which is the number of calls.
+    """
+    return count_calls(monkeypatch, spsla, "svds")
+
+
+# # # # # # # # # # # # # # # # # # # #
+# The actual tests
+
+
+def test_sparse_svd(n_iters, monkeypatch):
+    """Check that truncating a large SVD to a few singular values uses a
+    sparse SVD, and that it gives the known leading part of the
+    decomposition, the correct truncation error, and doesn't touch the global
+    random state.
+    """
+    calls = count_svds_calls(monkeypatch)
+    for iter_num in range(n_iters):
+        m, n1, n2 = random_sparse_svd_shape()
+        n = n1 * n2
+        k = min(m, n)
+        U_true = random_isometry(m, k)
+        V_true = random_isometry(n, k).conj().T
+        s_true = random_spectrum(k)
+        T = np.dot(U_true * s_true, V_true).reshape(m, n1, n2)
+        chi = np.random.randint(low=1, high=6)
+
+        state = np.random.get_state()
+        U, s, V, rel_err = svd(T, [0], [1, 2], chis=chi, return_rel_err=True)
+        next_rand = np.random.rand()
+        np.random.set_state(state)
+        assert next_rand == np.random.rand()
+
+        assert len(calls) == iter_num + 1
+        assert U.shape == (m, chi)
+        assert V.shape == (chi, n1, n2)
+        assert np.allclose(s, s_true[:chi])
+        true_rel_err = np.sqrt(sum(s_true[chi:] ** 2) / sum(s_true ** 2))
+        assert np.allclose(rel_err, true_rel_err, atol=1e-7)
+        USV = np.dot(U * s, V.reshape(chi, n))
+        USV_true = np.dot(U_true[:, :chi] * s_true[:chi], V_true[:chi, :])
+        assert np.allclose(USV, USV_true)
+
+
+def test_sparse_svd_degenerate(n_iters, monkeypatch):
+    """Check that the sparse SVD doesn't truncate in the middle of degenerate
+    singular values, unless break_degenerate=True.
+    """
+    calls = count_svds_calls(monkeypatch)
+    for iter_num in range(n_iters):
+        m, n1, n2 = random_sparse_svd_shape()
+        n = n1 * n2
+        k = min(m, n)
+        chi = np.random.randint(low=1, high=6)
+        s_true = random_spectrum(k)
+        s_true[chi] = s_true[chi - 1]
+        T = np.dot(
+            random_isometry(m, k) * s_true, random_isometry(n, k).conj().T
+        ).reshape(m, n1, n2)
+
+        s = svd(T, [0], [1, 2], chis=chi, compute_uv=False)
+        assert np.allclose(s, s_true[: chi - 1])
+        s = svd(T, [0], [1, 2], chis=chi, break_degenerate=True)[1]
+        assert np.allclose(s, s_true[:chi])
+        assert len(calls) == 2 * (iter_num + 1)
+
+
+def test_sparse_svd_no_convergence(n_iters, monkeypatch):
+    """Check that if the sparse SVD fails to converge, svd falls back to a
+    full SVD.
+    """
+
+    def failing_svds(*args, **kwargs):
+        raise spsla.ArpackNoConvergence("No convergence.", [], [])
+
+    for iter_num in range(n_iters):
+        m, n1, n2 = random_sparse_svd_shape()
+        T = np.random.randn(m, n1, n2) + 1j * np.random.randn(m, n1, n2)
+        chi = np.random.randint(low=1, high=6)
+        with monkeypatch.context() as mp:
+            mp.setattr(ndarray_decomp, "_SPARSE_SVD_MIN_DIM", np.inf)
+            res_full = svd(T, [0], [1, 2], chis=chi, return_rel_err=True)
+        with monkeypatch.context() as mp:
+            mp.setattr(spsla, "svds", failing_svds)
+            res = svd(T, [0], [1, 2], chis=chi, return_rel_err=True)
+        for x, x_full in zip(res, res_full):
+            assert np.allclose(x, x_full)
+
+
+def test_sparse_svd_unsupported_dtype(n_iters, monkeypatch):
+    """Check that svd decomposes tensors of dtypes that the sparse SVD doesn't
+    accept, such as integers, float16 and longdouble, with a full SVD.
+    """
+    calls = count_svds_calls(monkeypatch)
+    dtypes = [np.int_, np.float16, np.longdouble]
+    for iter_num in range(n_iters):
+        m, n1, n2 = random_sparse_svd_shape()
+        dtype = dtypes[iter_num % len(dtypes)]
+        T = np.random.randint(low=-5, high=6, size=(m, n1, n2)).astype(dtype)
+        chi = np.random.randint(low=1, high=6)
+        U, s, V, rel_err = svd(T, [0], [1, 2], chis=chi, return_rel_err=True)
+        T_matrix = T.reshape(m, n1 * n2).astype(np.float64)
+        s_full = np.linalg.svd(T_matrix, compute_uv=False)
+        assert len(calls) == 0
+        assert U.shape == (m, len(s))
+        assert V.shape == (len(s), n1, n2)
+        assert np.allclose(s, s_full[: len(s)], rtol=1e-4)
+        true_rel_err = np.sqrt(sum(s_full[len(s) :] ** 2) / sum(s_full ** 2))
+        assert np.allclose(rel_err, true_rel_err, rtol=1e-4)
+
+
+def test_eig_hermitian_auto(n_iters, monkeypatch):
+    """Check that eig with hermitian="auto" uses eigh for hermitian matrices,
+    including ones that are hermitian only up to rounding errors, and eig for
+    others.
+    """
+    eigh_calls = count_calls(monkeypatch, spla, "eigh")
+    eig_calls = count_calls(monkeypatch, spla, "eig")
+    for iter_num in range(n_iters):
+        n1 = np.random.randint(low=2, high=6)
+        n2 = np.random.randint(low=1, high=6)
+        n = n1 * n2
+        X = np.random.randn(n, n) + 1j * np.random.randn(n, n)
+        # The product is hermitian only up to rounding errors, which may
+        # make elements that should be zero slightly nonzero.
+        H = np.dot(X, X.conj().T)
+        H[0, -1] = H[-1, 0] = 0
+        H[-1, 0] += 1e-17
+        S, U = eig(H.reshape(n1, n2, n1, n2), [0, 1], [2, 3], hermitian="auto")
+        assert len(eigh_calls) == iter_num + 1
+        assert np.isrealobj(S)
+        assert U.shape == (n1, n2, n)
+        S_true = np.linalg.eigvalsh(H)
+        assert np.allclose(S, S_true[np.argsort(-np.abs(S_true))])
+
+        S, U = eig(X.reshape(n1, n2, n1, n2), [0, 1], [2, 3], hermitian="auto")
+        assert len(eig_calls) == iter_num + 1
+        U = U.reshape(n, n)
+        assert np.allclose(np.dot(X, U), U * S)
+
+
+def test_svd_no_uv(n_iters):
+    """Check that svd with compute_uv=False returns the same singular values
+    and truncation error as the full decomposition, for small matrices.
+    """
+    for iter_num in range(n_iters):
+        shp = tuple(np.random.randint(low=1, high=6, size=3))
+        T = np.random.randn(*shp) + 1j * np.random.randn(*shp)
+        chis = list(range(1, np.random.randint(low=2, high=8)))
+        eps = np.random.choice([0, 1e-1, 1e-2])
+        kwargs = dict(chis=chis, eps=eps)
+        U, s, V, rel_err = svd(T, [0, 2], [1], return_rel_err=True, **kwargs)
+        s_only = svd(T, [0, 2], [1], compute_uv=False, **kwargs)
+        assert np.allclose(s_only, s)
+        s_only, rel_err_only = svd(
+            T, [0, 2], [1], compute_uv=False, return_rel_err=True, **kwargs
+        )
+        assert np.allclose(s_only, s)
+        assert np.allclose(rel_err_only, rel_err)
+
+
+def test_negative_eps_zero_spectrum():
+    """Check that with eps < 0, svd and eig both keep max(chis) values of a
+    zero spectrum, as they do with eps = 0.
+    """
+    T = np.zeros((2, 2, 2, 2))
+    for eps in (0, -1):
+        S, U = eig(T, [0, 1], [2, 3], chis=[1, 3], eps=eps)
+        assert len(S) == 3
+        assert U.shape == (2, 2, 3)
+        s = svd(T, [0, 1], [2, 3], chis=[1, 3], eps=eps, compute_uv=False)
+        assert len(s) == 3